@@ -0,0 +1,357 @@
+"""streamlit_app.py の同時セッション負荷テスト
+
+Streamlit の AppTest を使い、1つのプロセス（= 1ワーカー）の中で
+N個のセッションを同時に動かして、再実行(rerun)ごとの待ち時間を測る。
+各セッションは check_password() でログインし、キーワード検索・
+カード色フィルターの切り替え・データ編集エリアからの保存を繰り返す。
+GitHub への保存はスタブに置き換える。
+
+使い方:
+    python load_test.py --sessions 1,5,10,20 --sizes 100,1000,10000
+
+AppTest は実行のたびに Runtime や st.secrets などのグローバル状態を
+差し替えるため、そのままでは並行に動かせない。ここではそれらを最初に
+一度だけ用意し、各セッションはスクリプトの実行だけを行う
+(requirements.txt で固定している streamlit 1.52 の内部APIに依存)。
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import defaultdict
+from unittest import mock
+from urllib import parse
+
+import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.pages_manager import PagesManager
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+from streamlit.testing.v1.util import patch_config_options
+
+from photo_store import ThumbnailPipeline
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "streamlit_app.py")
+SAMPLE_DATA = os.path.join(APP_DIR, "gourmet_data.json")
+
+PASSWORD = "load-test"
+SECRETS = {
+    "PASSWORD": PASSWORD,
+    "GITHUB_TOKEN": "dummy",
+    "GITHUB_USERNAME": "dummy",
+    "GITHUB_REPO_NAME": "dummy",
+    "DATA_FILE_PATH": "gourmet_data.json",
+}
+SEARCH_WORDS = ["ラーメン", "京都", "名古屋", "焼肉", "カフェ", "おすすめ", "雰囲気", "店"]
+COLORS = ["Black", "Gold", "Silver", "Bronze", "Normal"]
+INTERACTIVE_ACTIONS = ["search", "filter"]
+
+# ==========================================
+# GitHubのスタブ
+# ==========================================
+class FakeRepo:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_contents(self, path):
+        time.sleep(self.latency)
+        return mock.Mock(path=path, sha="0" * 40)
+
+    def update_file(self, path, message, content, sha):
+        time.sleep(self.latency)
+
+    def create_file(self, path, message, content):
+        time.sleep(self.latency)
+
+def fake_github_factory(latency):
+    def fake_github(token):
+        user = mock.Mock()
+        user.get_repo.return_value = FakeRepo(latency)
+        github = mock.Mock()
+        github.get_user.return_value = user
+        return github
+    return fake_github
+
+# ==========================================
+# サムネイル生成パイプラインの後始末
+# ==========================================
+class TrackedThumbnailPipeline(ThumbnailPipeline):
+    """シナリオの切り替え時に止められるよう、作られたパイプラインを記録する"""
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instances.append(self)
+
+def reset_app_resources():
+    """st.cache_resource を空にする前に、パイプラインのスレッドとプロセスを止める"""
+    while TrackedThumbnailPipeline.instances:
+        TrackedThumbnailPipeline.instances.pop().shutdown()
+    st.cache_resource.clear()
+    gc.collect()
+
+# 本番のサーバーと同じく、コンパイル済みのスクリプトを全セッションで共有する
+SCRIPT_CACHE = ScriptCache()
+
+# ==========================================
+# 並行実行できる AppTest
+# ==========================================
+class SessionAppTest(AppTest):
+    """グローバル状態に触れずにスクリプトだけを実行する AppTest"""
+
+    def _run(self, widget_state=None, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        pages_manager = PagesManager(self._script_path, SCRIPT_CACHE, setup_watcher=False)
+        script_runner = LocalScriptRunner(self._script_path, self.session_state, pages_manager, args=self.args, kwargs=self.kwargs)
+        script_runner._script_cache = SCRIPT_CACHE
+        self._tree = script_runner.run(widget_state, self.query_params, timeout, self._page_hash)
+        self._tree._runner = self
+        query_string = script_runner.event_data[-1]["client_state"].query_string
+        self.query_params = parse.parse_qs(query_string)
+        return self
+
+def install_test_runtime():
+    """AppTest._run が毎回行う準備を、全セッション共通で一度だけ行う"""
+    runtime = mock.MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+    secrets = Secrets()
+    secrets._secrets = dict(SECRETS)
+    st.secrets = secrets
+    SCRIPT_CACHE.get_bytecode(APP_PATH)
+
+# ==========================================
+# データとメトリクス
+# ==========================================
+def make_dataset(size, path, seed=0):
+    """サンプルデータを元に、指定件数の店データを作る"""
+    rng = random.Random(seed)
+    with open(SAMPLE_DATA, "r", encoding="utf-8") as f:
+        samples = json.load(f)
+    data = []
+    for i in range(size):
+        entry = dict(rng.choice(samples))
+        entry["id"] = f"{1700000000 + i}.{i:06d}"
+        entry["order"] = i + 1
+        entry["color"] = rng.choice(COLORS)
+        for key in ["total", "taste", "service", "specialty"]:
+            entry[key] = rng.randint(0, 5)
+        entry["cost_performance"] = rng.randint(1, 5)
+        data.append(entry)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+def current_rss_mb():
+    """現在のRSS(MB)。/proc が無い環境では最大RSSで代用する"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+# ==========================================
+# セッションの動作
+# ==========================================
+def find_widget(widgets, label):
+    for widget in widgets:
+        if widget.label == label:
+            return widget
+    raise LookupError(f"ウィジェットが見つかりません: {label}")
+
+class Session:
+    def __init__(self, index, args, records):
+        self.rng = random.Random(index)
+        self.args = args
+        self.records = records
+        self.at = SessionAppTest(APP_PATH, default_timeout=args.timeout)
+
+    def timed(self, action, func):
+        start = time.perf_counter()
+        try:
+            func()
+            if self.at.exception:
+                raise RuntimeError(self.at.exception[0].message)
+            ok = True
+        except Exception:
+            if self.args.verbose:
+                traceback.print_exc()
+            ok = False
+        self.records.append((action, time.perf_counter() - start, ok))
+
+    def login(self):
+        self.timed("open", self.at.run)
+        self.timed("login", lambda: (
+            find_widget(self.at.text_input, "パスワードを入力してください").input(PASSWORD),
+            find_widget(self.at.button, "ログイン").click(),
+            self.at.run(),
+        ))
+
+    def search(self):
+        word = self.rng.choice(SEARCH_WORDS + [""])
+        self.timed("search", lambda: find_widget(self.at.text_input, "キーワード検索").input(word).run())
+
+    def toggle_filter(self):
+        def toggle():
+            widget = find_widget(self.at.multiselect, "カードの色で絞り込み")
+            color = self.rng.choice(COLORS)
+            (widget.unselect(color) if color in widget.value else widget.select(color)).run()
+        self.timed("filter", toggle)
+
+    def save(self):
+        # data_editor の編集は AppTest から操作できないため、表示中の内容のまま保存する
+        self.timed("save", lambda: find_widget(self.at.button, "変更を保存").click().run())
+
+    def run(self, barrier):
+        barrier.wait()
+        self.login()
+        for i in range(self.args.iterations):
+            self.search()
+            self.toggle_filter()
+            self.search()
+            if self.args.save_every and i % self.args.save_every == 0:
+                self.save()
+
+# ==========================================
+# 計測の実行
+# ==========================================
+def run_scenario(n_sessions, args):
+    records = []
+    sessions = [Session(i, args, records) for i in range(n_sessions)]
+    barrier = threading.Barrier(n_sessions + 1)
+    threads = [threading.Thread(target=s.run, args=(barrier,), daemon=True) for s in sessions]
+    # 前のシナリオで確保したままのメモリを含めないよう、開始直前の値からの増加分を見る
+    gc.collect()
+    baseline_rss = peak_rss = current_rss_mb()
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(0.2)
+        peak_rss = max(peak_rss, current_rss_mb())
+    elapsed = time.perf_counter() - start
+    return summarize(records, elapsed, baseline_rss, peak_rss)
+
+def summarize(records, elapsed, baseline_rss, peak_rss):
+    def stats(latencies):
+        ms = [t * 1000 for t in latencies]
+        return {
+            "count": len(ms),
+            "p50_ms": percentile(ms, 50),
+            "p95_ms": percentile(ms, 95),
+            "p99_ms": percentile(ms, 99),
+            "mean_ms": statistics.fmean(ms) if ms else float("nan"),
+        }
+    by_action = defaultdict(list)
+    for action, latency, ok in records:
+        if ok:
+            by_action[action].append(latency)
+    result = stats([latency for _, latency, ok in records if ok])
+    result.update({
+        "errors": sum(1 for _, _, ok in records if not ok),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(records) / elapsed if elapsed else float("nan"),
+        "rss_baseline_mb": baseline_rss,
+        "rss_peak_mb": peak_rss,
+        "rss_delta_mb": peak_rss - baseline_rss,
+        "actions": {action: stats(latencies) for action, latencies in by_action.items()},
+        # 保存は save_data() 内で2秒待ち、open/login は最初の1回だけなので、
+        # 操作中の待ち時間と容量の判定は検索・絞り込みだけで見る
+        "interactive": stats([t for a in INTERACTIVE_ACTIONS for t in by_action[a]]),
+    })
+    return result
+
+HEADER = (f"{'size':>8} {'sessions':>8} {'reruns':>7} {'errors':>6} "
+          f"{'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'全体p95':>9} {'rerun/s':>8} {'RSS増(MB)':>9}")
+
+def print_row(size, n_sessions, r):
+    """p50/p95/p99 は検索・絞り込みのrerun、全体p95 は保存やログインも含めた値"""
+    i = r["interactive"]
+    print(f"{size:>8} {n_sessions:>8} {r['count']:>7} {r['errors']:>6} "
+          f"{i['p50_ms']:>9.1f} {i['p95_ms']:>9.1f} {i['p99_ms']:>9.1f} {r['p95_ms']:>9.1f} "
+          f"{r['throughput_rps']:>8.2f} {r['rss_delta_mb']:>9.1f}", flush=True)
+    actions = ", ".join(f"{action} p95={a['p95_ms']:.0f}ms" for action, a in r["actions"].items())
+    print(f"{'':>17} {actions}", flush=True)
+
+def parse_ints(text):
+    return [int(v) for v in text.split(",") if v.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="streamlit_app.py の同時セッション負荷テスト")
+    parser.add_argument("--sessions", type=parse_ints, default=[1, 5, 10, 20], help="同時セッション数（カンマ区切り）")
+    parser.add_argument("--sizes", type=parse_ints, default=[100, 1000], help="店データの件数（カンマ区切り）")
+    parser.add_argument("--iterations", type=int, default=5, help="1セッションあたりの操作の繰り返し回数")
+    parser.add_argument("--save-every", type=int, default=5, help="何回の繰り返しごとに保存するか（0で保存しない）")
+    parser.add_argument("--github-latency", type=float, default=0.0, help="GitHubスタブの応答時間（秒）")
+    parser.add_argument("--timeout", type=float, default=120.0, help="1回のrerunのタイムアウト（秒）")
+    parser.add_argument("--target-p95", type=float, default=1000.0, help="検索・絞り込みで許容するp95待ち時間（ms）。容量の判定に使う")
+    parser.add_argument("--json", help="結果をJSONで書き出すファイル")
+    parser.add_argument("--verbose", action="store_true", help="失敗した操作のトレースバックを表示する")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    sys.path.insert(0, APP_DIR)
+    workdir = tempfile.mkdtemp(prefix="gourmet_load_")
+    shutil.copy(os.path.join(APP_DIR, "style.css"), workdir)
+    os.chdir(workdir)
+    install_test_runtime()
+
+    results = []
+    print("p50/p95/p99 は検索・絞り込みのrerun、全体p95 は保存（2秒待ちを含む）やログインも含む")
+    print("RSS増 はシナリオ開始直前からのピークの増加分（絶対値は --json の rss_baseline_mb / rss_peak_mb）")
+    print(HEADER)
+    try:
+        with mock.patch("github.Github", fake_github_factory(args.github_latency)), \
+                mock.patch("photo_store.ThumbnailPipeline", TrackedThumbnailPipeline), \
+                patch_config_options({"global.appTest": True}):
+            for size in args.sizes:
+                # 容量は、目標を初めて満たせなかったセッション数の手前までとする
+                capacity, exceeded = 0, False
+                for n_sessions in sorted(args.sessions):
+                    make_dataset(size, os.path.join(workdir, "gourmet_data.json"))
+                    reset_app_resources()
+                    r = run_scenario(n_sessions, args)
+                    print_row(size, n_sessions, r)
+                    results.append({"size": size, "sessions": n_sessions, **r})
+                    if r["errors"] or not r["interactive"]["p95_ms"] <= args.target_p95:
+                        exceeded = True
+                    elif not exceeded:
+                        capacity = n_sessions
+                reset_app_resources()
+                print(f"  -> {size}件: 検索・絞り込みの p95 <= {args.target_p95:.0f}ms を満たす最大同時セッション数 = {capacity}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""写真の保存とサムネイル生成（コンテンツアドレス方式）
+
+元画像は内容のSHA-256をファイル名にして保存し、サムネイルはハッシュと
+生成設定から決まる名前で static/ 以下に書き出す。画像や設定が変われば名前も
+変わるため、ファイルが存在すること自体がキャッシュの有効性を表す。
+サムネイル生成は ProcessPoolExecutor で別プロセスに振り分けるので、
+このモジュールは streamlit に依存させずに単体で import できるようにし、
+ワーカーの起動中は __main__ を差し替えてアプリ本体を読み込ませない。
+"""
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import queue
+import re
+import sys
+import threading
+import types
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps, features
+
+PHOTO_CONFIG = {
+    "original_dir": os.path.join("photos", "originals"),  # 非公開（静的配信しない）
+    "thumb_dir": os.path.join("static", "thumbs"),        # enableStaticServing で配信
+    "thumb_url": "app/static/thumbs",
+    "thumb_size": (240, 180),
+    "thumb_format": "WEBP" if features.check("webp") else "JPEG",
+    "thumb_quality": 80,
+    "batch_size": 16,      # 1回にまとめて処理する最大枚数
+    "batch_wait": 0.2,     # バッチが埋まるまで待つ秒数
+    "max_workers": 4,      # サムネイル生成プロセス数の上限
+}
+
+EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg"}
+
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+def photo_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def is_valid_digest(digest):
+    """SHA-256の16進表記か（JSONの値をそのままパスやURLに使わないための確認）"""
+    return isinstance(digest, str) and DIGEST_PATTERN.fullmatch(digest) is not None
+
+def _check_digest(digest):
+    if not is_valid_digest(digest):
+        raise ValueError(f"不正な写真ハッシュです: {digest!r}")
+
+def original_path(digest):
+    _check_digest(digest)
+    return os.path.join(PHOTO_CONFIG["original_dir"], digest[:2], digest)
+
+def thumbnail_name(digest):
+    _check_digest(digest)
+    width, height = PHOTO_CONFIG["thumb_size"]
+    ext = EXTENSIONS[PHOTO_CONFIG["thumb_format"]]
+    return f"{digest}_{width}x{height}_q{PHOTO_CONFIG['thumb_quality']}.{ext}"
+
+def thumbnail_path(digest):
+    return os.path.join(PHOTO_CONFIG["thumb_dir"], thumbnail_name(digest))
+
+def thumbnail_url(digest):
+    return f"{PHOTO_CONFIG['thumb_url']}/{thumbnail_name(digest)}"
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def make_thumbnail(digest):
+    """元画像から固定サイズのサムネイルを作る。(ハッシュ, 成功したか) を返す"""
+    if not is_valid_digest(digest):
+        return digest, False
+    path = thumbnail_path(digest)
+    if os.path.exists(path):
+        return digest, True
+    try:
+        with Image.open(original_path(digest)) as img:
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            thumb = ImageOps.fit(img, PHOTO_CONFIG["thumb_size"], Image.Resampling.LANCZOS)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        thumb.save(tmp_path, PHOTO_CONFIG["thumb_format"], quality=PHOTO_CONFIG["thumb_quality"])
+        os.replace(tmp_path, path)
+        return digest, True
+    except Exception:
+        return digest, False
+
+_main_lock = threading.Lock()
+
+@contextlib.contextmanager
+def _neutral_main():
+    """ワーカープロセスの起動中だけ __main__ を空のモジュールに差し替える
+
+    spawn で起動したワーカーは親の __main__.__file__ を読み込み直すが、
+    Streamlit の実行中はそれがアプリのスクリプトになっているため、
+    streamlit や numpy まで各ワーカーに読み込まれてしまう。
+    """
+    neutral = types.ModuleType("__main__")
+    with _main_lock:
+        saved = sys.modules.get("__main__")
+        sys.modules["__main__"] = neutral
+        try:
+            yield
+        finally:
+            # 途中でスクリプトの実行が始まって差し替えられていたら、そちらを優先する
+            if sys.modules.get("__main__") is neutral:
+                sys.modules["__main__"] = saved
+
+class ThumbnailPipeline:
+    """アップロードの保存とサムネイル生成をバックグラウンドで行う
+
+    保存はスレッドで、サムネイル生成はキューに溜めたものをバッチ単位で
+    CPUコア数（max_workers まで）のプロセスに分配して処理する。
+    """
+
+    def __init__(self, workers=None):
+        self.uploads = ThreadPoolExecutor(max_workers=2)
+        self.workers = workers or min(PHOTO_CONFIG["max_workers"], os.cpu_count() or 1)
+        self.processes = self._new_pool()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.uploading = set()
+        self.pending = set()
+        self.failed = set()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _restart_pool(self):
+        self.processes.shutdown(wait=False, cancel_futures=True)
+        self.processes = self._new_pool()
+
+    def shutdown(self):
+        """スレッドとワーカープロセスを止める（キューに残った分は捨てる）"""
+        self.queue.put(None)
+        self.uploads.shutdown(wait=True)
+        self.thread.join()
+        self.processes.shutdown(wait=True, cancel_futures=True)
+
+    def submit_upload(self, data):
+        """画像のハッシュをすぐに返し、保存とサムネイル生成は裏で行う"""
+        digest = photo_hash(data)
+        with self.lock:
+            self.uploading.add(digest)
+        self.uploads.submit(self._store, digest, data)
+        return digest
+
+    def _store(self, digest, data):
+        try:
+            if not os.path.exists(original_path(digest)):
+                _write_atomic(original_path(digest), data)
+        finally:
+            with self.lock:
+                self.uploading.discard(digest)
+                self.failed.discard(digest)
+        self.request(digest)
+
+    def ready(self, digest):
+        return is_valid_digest(digest) and os.path.exists(thumbnail_path(digest))
+
+    def request(self, digest):
+        """サムネイルがまだ無ければ生成キューに積む（不正なハッシュは無視する）"""
+        if not is_valid_digest(digest):
+            return
+        if digest in self.pending or digest in self.failed or digest in self.uploading:
+            return
+        # ファイルの確認はロックの外で行い、カードの描画どうしを待たせない
+        if self.ready(digest):
+            return
+        has_original = os.path.exists(original_path(digest))
+        with self.lock:
+            if digest in self.pending or digest in self.failed or digest in self.uploading:
+                return
+            if not has_original:
+                self.failed.add(digest)
+                return
+            self.pending.add(digest)
+        self.queue.put(digest)
+
+    def _map(self, batch):
+        chunksize = max(1, len(batch) // self.workers)
+        with _neutral_main():
+            results = self.processes.map(make_thumbnail, batch, chunksize=chunksize)
+        return list(results)
+
+    def _process(self, batch):
+        try:
+            return self._map(batch)
+        except BrokenProcessPool:
+            # ワーカーが落ちた（巨大な画像でのメモリ不足など）。プールを作り直し、
+            # 原因の画像だけを失敗扱いにするため1枚ずつやり直す
+            self._restart_pool()
+            results = []
+            for digest in batch:
+                try:
+                    results.extend(self._map([digest]))
+                except BrokenProcessPool:
+                    self._restart_pool()
+                    results.append((digest, False))
+            return results
+
+    def _run(self):
+        while True:
+            digest = self.queue.get()
+            if digest is None:
+                return
+            batch = [digest]
+            try:
+                while len(batch) < PHOTO_CONFIG["batch_size"]:
+                    digest = self.queue.get(timeout=PHOTO_CONFIG["batch_wait"])
+                    if digest is None:
+                        # このバッチを処理してから止まる
+                        self.queue.put(None)
+                        break
+                    batch.append(digest)
+            except queue.Empty:
+                pass
+            try:
+                results = self._process(batch)
+            except Exception:
+                results = [(digest, False) for digest in batch]
+            with self.lock:
+                for digest, ok in results:
+                    self.pending.discard(digest)
+                    if not ok:
+                        self.failed.add(digest)
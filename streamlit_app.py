@@ -3,8 +3,13 @@ import pandas as pd
 import json
 import os
 import time
+import math
+import threading
+from collections import Counter, defaultdict
 from datetime import datetime
+import numpy as np
 from github import Github
+from photo_store import ThumbnailPipeline, is_valid_digest, thumbnail_url
 
 # ==========================================
 # 0. 認証機能
@@ -113,6 +118,262 @@ def show_delete_dialog(item_data, current_data):
         if st.button("キャンセル", use_container_width=True):
             st.rerun()
 
+# ==========================================
+# 2.5 類似店舗の推薦
+# ==========================================
+SIMILARITY_CONFIG = {
+    "ngram": 2,                  # メモを分割する文字n-gramの長さ
+    "max_df_ratio": 0.5,         # これより多くの店に出現するn-gramは語彙から外す
+    "rebuild_ratio": 0.3,        # 削除済みの行や、IDF計算時からの件数の増減がこの割合を超えたら作り直す
+    "first_build_wait": 2.0,     # 最初の構築をその場で待つ最大秒数（これより長ければ「準備中」と表示）
+    "weights": {"rating": 0.5, "memo": 0.3, "genre": 0.15, "atmosphere": 0.05},
+}
+
+RATING_ITEMS = [c for c in APP_CONFIG["criteria"] if c["type"] == "slider"]
+EMPTY_POSTING = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+
+def _to_number(val, default):
+    try:
+        num = float(val)
+    except (TypeError, ValueError):
+        return default
+    return num if math.isfinite(num) else default
+
+def _memo_counts(text):
+    """メモを文字n-gramに分割し、(1+log tf) の重みを返す"""
+    n = SIMILARITY_CONFIG["ngram"]
+    text = "".join(str(text or "").lower().split())
+    counts = Counter(text[i:i + n] for i in range(len(text) - n + 1))
+    return {g: 1.0 + math.log(c) for g, c in counts.items()}
+
+def _signature(entry):
+    """インデックスに関係する項目だけを取り出す（変更検出用）"""
+    return tuple(str(entry.get(k, "")) for k in [c["id"] for c in RATING_ITEMS] + ["genre", "atmosphere", "memo"])
+
+def get_data_version():
+    """保存ファイルの更新時刻（インデックスを更新するかの判定に使う）"""
+    try:
+        return os.stat(APP_CONFIG["save_file"]).st_mtime_ns
+    except OSError:
+        return 0
+
+class SimilarityIndex:
+    """評価ベクトルのNumPy距離とメモのTF-IDFを組み合わせた類似店舗インデックス
+
+    店ごとの行を追記していき、変更・削除された行は無効化するだけにして
+    全件の作り直しを避ける。検索は評価ベクトルとの距離をまとめて計算し、
+    メモはn-gramの転置インデックスから共通するn-gramを持つ店だけを集計する。
+    更新は refresh() から裏のスレッドで行い、検索を待たせるのは
+    計算済みの差分を反映する間だけにする。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()        # 検索と差分の反映の排他
+        self.sync_lock = threading.Lock()   # 更新処理は同時に1つだけ
+        self.version = None                 # 反映済みデータの get_data_version()
+        self.thread = None                  # 更新中のスレッド
+        self._reset()
+
+    def _reset(self):
+        self.row_ids = []                      # 行番号 -> 店ID
+        self.rows = {}                         # 店ID -> 行番号
+        self.signatures = {}                   # 店ID -> 登録時の内容
+        self.ratings = np.zeros((0, len(RATING_ITEMS)), dtype=np.float32)
+        self.genres = np.zeros(0, dtype=np.int32)
+        self.atmospheres = np.zeros(0, dtype=np.int32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.row_grams = []                    # 行番号 -> {n-gram: L2正規化したTF-IDF}
+        self.postings = {}                     # n-gram -> (行番号の配列, 重みの配列)
+        self.idf = {}                          # 作り直した時点のIDF
+        self.idf_docs = 0                      # IDFを計算したときの店の数
+        self.stop_grams = set()                # 多くの店に出現するため語彙から外したn-gram
+        self.codes = defaultdict(lambda: len(self.codes))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def ready(self):
+        return self.version is not None
+
+    # --- 更新 ---
+    def refresh(self, data, version):
+        """データが変わっていれば、裏のスレッドでインデックスを更新する"""
+        if version == self.version or not self.sync_lock.acquire(blocking=False):
+            return
+        self.thread = threading.Thread(target=self._refresh, args=(data, version), daemon=True)
+        self.thread.start()
+
+    def wait(self, timeout):
+        """更新中のスレッドを最大 timeout 秒待つ"""
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _refresh(self, data, version):
+        try:
+            self.sync(data)
+            self.version = version
+        finally:
+            self.sync_lock.release()
+
+    def sync(self, data):
+        """現在のデータとの差分だけをインデックスに反映する"""
+        current = {str(d["id"]): d for d in data if "id" in d}
+        removed = [i for i in self.rows if i not in current]
+        changed = {}
+        for shop_id, entry in current.items():
+            sig = _signature(entry)
+            if self.signatures.get(shop_id) != sig:
+                changed[shop_id] = (entry, sig)
+
+        ratio = SIMILARITY_CONFIG["rebuild_ratio"]
+        dead = len(self.row_ids) - len(self.rows) + len(removed) + sum(1 for i in changed if i in self.rows)
+        drift = abs(len(current) - self.idf_docs) > self.idf_docs * ratio
+        if not self.row_ids or drift or dead > (len(self.row_ids) + len(changed)) * ratio:
+            self._rebuild(current)
+            return
+
+        prepared = [(shop_id, sig, self._prepare(entry)) for shop_id, (entry, sig) in changed.items()]
+        self._apply(removed + [i for i in changed if i in self.rows], prepared)
+
+    def _rebuild(self, current):
+        """IDFを計算し直して別のインデックスを作り、できあがったら差し替える"""
+        fresh = SimilarityIndex()
+        counts = {shop_id: _memo_counts(entry.get("memo")) for shop_id, entry in current.items()}
+        doc_freq = Counter(g for grams in counts.values() for g in grams)
+        n_docs = len(current)
+        max_df = max(1, n_docs * SIMILARITY_CONFIG["max_df_ratio"])
+        fresh.stop_grams = {g for g, df in doc_freq.items() if df > max_df}
+        fresh.idf = {g: math.log((1 + n_docs) / (1 + df)) + 1 for g, df in doc_freq.items() if df <= max_df}
+        fresh.idf_docs = n_docs
+        fresh._apply([], [(shop_id, _signature(entry), fresh._prepare(entry, counts[shop_id])) for shop_id, entry in current.items()])
+        with self.lock:
+            for key, value in vars(fresh).items():
+                if key not in ("lock", "sync_lock", "version", "thread"):
+                    setattr(self, key, value)
+
+    def _prepare(self, entry, counts=None):
+        """1店ぶんの評価ベクトルとメモのTF-IDFを計算する（ロックの外で呼ぶ）"""
+        vec = [(_to_number(entry.get(c["id"]), c["min"]) - c["min"]) / (c["max"] - c["min"]) for c in RATING_ITEMS]
+        if counts is None:
+            counts = _memo_counts(entry.get("memo"))
+        unseen_idf = math.log(1 + self.idf_docs) + 1
+        weights = {g: tf * self.idf.get(g, unseen_idf) for g, tf in counts.items() if g not in self.stop_grams}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        grams = {g: w / norm for g, w in weights.items()} if norm else {}
+        return vec, entry.get("genre"), entry.get("atmosphere"), grams
+
+    def _apply(self, removed, prepared):
+        """行の無効化と追加をまとめて反映する
+
+        新しいNumPy配列（転置インデックスを含む）はロックの外で作っておき、
+        ロック内では差し替えだけを行う。検索側は配列を読むだけで済む。
+        """
+        start = len(self.row_ids)
+        alive = self.alive.copy()
+        alive[[self.rows[i] for i in removed if i in self.rows]] = False
+        alive = np.concatenate([alive, np.ones(len(prepared), dtype=bool)])
+        vecs = np.asarray([row[0] for _, _, row in prepared], dtype=np.float32).reshape(-1, len(RATING_ITEMS))
+        genres = np.asarray([self.codes[("genre", row[1])] for _, _, row in prepared], dtype=np.int32)
+        atmospheres = np.asarray([self.codes[("atmosphere", row[2])] for _, _, row in prepared], dtype=np.int32)
+        ratings = np.vstack([self.ratings, vecs])
+        genres = np.concatenate([self.genres, genres])
+        atmospheres = np.concatenate([self.atmospheres, atmospheres])
+
+        added = defaultdict(lambda: ([], []))
+        for offset, (_, _, row) in enumerate(prepared):
+            for g, w in row[3].items():
+                rows, weights = added[g]
+                rows.append(start + offset)
+                weights.append(w)
+        postings = {}
+        for g, (rows, weights) in added.items():
+            old_rows, old_weights = self.postings.get(g, EMPTY_POSTING)
+            postings[g] = (np.concatenate([old_rows, np.asarray(rows, dtype=np.int64)]),
+                           np.concatenate([old_weights, np.asarray(weights, dtype=np.float32)]))
+
+        with self.lock:
+            for shop_id in removed:
+                row = self.rows.pop(shop_id, None)
+                if row is not None:
+                    self.signatures.pop(shop_id, None)
+                    self.row_grams[row] = {}
+            for shop_id, sig, row in prepared:
+                self.rows[shop_id] = len(self.row_ids)
+                self.row_ids.append(shop_id)
+                self.signatures[shop_id] = sig
+                self.row_grams.append(row[3])
+            self.ratings, self.genres, self.atmospheres, self.alive = ratings, genres, atmospheres, alive
+            self.postings.update(postings)
+
+    # --- 検索 ---
+    def similar(self, shop_ids, k=5):
+        """指定した店（複数可）に似ている店を、(店ID, 類似度) のリストで返す"""
+        with self.lock:
+            seeds = [self.rows[i] for i in shop_ids if i in self.rows]
+            if not seeds:
+                return []
+            n_rows = len(self.row_ids)
+            weights = SIMILARITY_CONFIG["weights"]
+
+            # 評価ベクトル：正規化したユークリッド距離を類似度に変換
+            center = self.ratings[seeds].mean(axis=0)
+            dist = np.sqrt(((self.ratings - center) ** 2).sum(axis=1))
+            score = weights["rating"] * (1.0 - dist / math.sqrt(len(RATING_ITEMS)))
+
+            # ジャンル・雰囲気：一致する基準店の割合
+            for key, codes in (("genre", self.genres), ("atmosphere", self.atmospheres)):
+                seed_codes, counts = np.unique(codes[seeds], return_counts=True)
+                match = np.zeros(n_rows, dtype=np.float32)
+                for code, count in zip(seed_codes, counts):
+                    match[codes == code] = count / len(seeds)
+                score += weights[key] * match
+
+            # メモ：基準店のTF-IDFベクトルの重心と各店とのコサイン類似度
+            query = Counter()
+            for row in seeds:
+                for g, w in self.row_grams[row].items():
+                    query[g] += w
+            norm = math.sqrt(sum(w * w for w in query.values()))
+            if norm:
+                postings = [self.postings.get(g, EMPTY_POSTING) for g in query]
+                rows = np.concatenate([p[0] for p in postings])
+                doc_weights = np.concatenate([p[1] * (w / norm) for p, w in zip(postings, query.values())])
+                score += weights["memo"] * np.bincount(rows, weights=doc_weights, minlength=n_rows)
+
+            score[~self.alive] = -np.inf
+            score[seeds] = -np.inf
+            candidates = np.flatnonzero(score > -np.inf)
+            k = min(k, len(candidates))
+            if k <= 0:
+                return []
+            top = candidates[np.argpartition(-score[candidates], k - 1)[:k]]
+            top = top[np.argsort(-score[top])]
+            return [(self.row_ids[r], float(score[r])) for r in top]
+
+@st.cache_resource
+def get_similarity_index():
+    """全セッションで共有する類似店舗インデックス"""
+    return SimilarityIndex()
+
+@st.cache_resource
+def get_thumbnail_pipeline():
+    """全セッションで共有するサムネイル生成パイプライン"""
+    return ThumbnailPipeline()
+
+def build_photo_strip(entry, pipeline):
+    """カード用のサムネイル列を生成（画像はURL参照で遅延読み込み）"""
+    thumbs = ""
+    for digest in entry.get("photos") or []:
+        if not is_valid_digest(digest):
+            # 復元したJSONなどに含まれる不正な値は、パスにもURLにも使わない
+            continue
+        if pipeline.ready(digest):
+            thumbs += f'<img src="{thumbnail_url(digest)}" loading="lazy" decoding="async" class="photo-thumb" alt="">'
+        else:
+            pipeline.request(digest)
+    return f'<div class="photo-strip">{thumbs}</div>' if thumbs else ""
+
 # ==========================================
 # 3. アプリのメイン処理
 # ==========================================
@@ -171,6 +432,7 @@ def main():
             | <span style="font-size: 0.78em;">**￥**</span> | ～2000円/人 | 
             """, unsafe_allow_html=True)
 
+    data_version = get_data_version()
     data = load_data()
 
     # --- サイドバー：登録 ---
@@ -205,6 +467,26 @@ def main():
                 st.success("登録しました！")
                 st.rerun()
 
+    # --- サイドバー：写真 ---
+    with st.sidebar:
+        st.markdown("---")
+        st.header("写真を追加")
+        photo_map = {f"{d['name']} ({d['date']})": d['id'] for d in data}
+        photo_label = st.selectbox("写真を追加するお店を選択", options=[""] + list(photo_map.keys()), index=0)
+        photo_files = st.file_uploader("写真をアップロード", type=["jpg", "jpeg", "png", "webp"], accept_multiple_files=True)
+        if photo_label and photo_files and st.button("写真を追加する", type="primary"):
+            pipeline = get_thumbnail_pipeline()
+            target_item = next((d for d in data if d['id'] == photo_map[photo_label]), None)
+            photos = list(target_item.get("photos") or [])
+            for photo_file in photo_files:
+                digest = pipeline.submit_upload(photo_file.getvalue())
+                if digest not in photos:
+                    photos.append(digest)
+            target_item["photos"] = photos
+            save_data(data)
+            st.success("写真を追加しました！")
+            st.rerun()
+
     # --- サイドバー：削除 ---
     with st.sidebar:
         st.markdown("---")
@@ -261,6 +543,41 @@ def main():
                 except Exception as e:
                     st.error("ファイルの読み込みに失敗しました。")
 
+    # --- 似ているお店 ---
+    # 選んだお店は ?similar=<店ID> に反映し、URLからも同じ状態で開けるようにする
+    similar_ids = st.query_params.get_all("similar")
+    with st.expander("似ているお店を探す", expanded=bool(similar_ids)):
+        if data:
+            shop_map = {f"{d['name']} ({d['date']})": str(d['id']) for d in data}
+            if "similar_seeds" not in st.session_state:
+                st.session_state.similar_seeds = [label for label, shop_id in shop_map.items() if shop_id in similar_ids]
+            st.session_state.similar_seeds = [label for label in st.session_state.similar_seeds if label in shop_map][:3]
+            sim_col1, sim_col2 = st.columns([3, 1])
+            with sim_col1:
+                seed_labels = st.multiselect("基準にするお店（3件まで）", options=list(shop_map.keys()), max_selections=3, key="similar_seeds")
+            with sim_col2:
+                top_k = st.number_input("表示件数", min_value=1, max_value=20, value=5, step=1)
+            seed_ids = [shop_map[label] for label in seed_labels]
+            if seed_ids != similar_ids:
+                st.query_params["similar"] = seed_ids
+            if seed_labels:
+                index = get_similarity_index()
+                index.refresh(data, data_version)
+                if not index.ready:
+                    # 件数が少なければすぐ終わるので、少しだけ完成を待つ
+                    index.wait(SIMILARITY_CONFIG["first_build_wait"])
+                by_id = {str(d['id']): d for d in data}
+                results = [(i, score) for i, score in index.similar(seed_ids, k=int(top_k)) if i in by_id]
+                if not index.ready:
+                    st.info("類似店舗のインデックスを準備中です。しばらくしてから再度お試しください。")
+                elif results:
+                    st.dataframe(pd.DataFrame([
+                        {"店名": by_id[i]["name"], "ジャンル": by_id[i].get("genre", "-"), "カード色": by_id[i].get("color", "-"), "類似度": round(score, 3)}
+                        for i, score in results
+                    ]), hide_index=True, use_container_width=True)
+                else:
+                    st.info("似ているお店が見つかりませんでした。")
+
     # --- フィルターエリア ---
     st.subheader("検索・絞り込み")
     fil_col1, fil_col2, fil_col3 = st.columns([1, 1, 1])
@@ -300,6 +617,7 @@ def main():
     else:
         # 1. コンテナ開始タグ
         html_parts = ['<div class="card-container">']
+        pipeline = get_thumbnail_pipeline()
         
         # 2. カードHTMLを生成してリストに追加
         for entry in display_data:
@@ -348,6 +666,7 @@ def main():
                     <div class="flip-card-back card {color_class}">
                         <h3>{entry['name']}</h3>
                         {back_info}
+                        {build_photo_strip(entry, pipeline)}
                     </div>
                 </label>
             </div>"""